@@ -3,21 +3,30 @@ import os  # Import the os module
 # Define the temporary directory used for extracting files
 temp_dir = 'extracted_stm_files'  # Update this to the actual directory path if different
 
+# Recursively delete everything below `path`: in each directory the files go first, then the
+# subdirectories, each emptied depth-first before it is removed
+def _rmtree_scandir(path):
+    # Collect the entries before deleting so readdir and unlink are never interleaved
+    with os.scandir(path) as it:
+        entries = list(it)
+    dirs = [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+    files = [entry for entry in entries if not entry.is_dir(follow_symlinks=False)]
+
+    for entry in files:
+        os.unlink(entry.path)
+        print(f"Deleted file: {entry.path}")
+    for entry in dirs:
+        _rmtree_scandir(entry.path)
+        os.rmdir(entry.path)
+        print(f"Deleted directory: {entry.path}")
+
 # Clean up: Remove files first, then directories
 def cleanup_temp_directory(temp_dir):
     if not os.path.exists(temp_dir):
         print(f"The directory '{temp_dir}' does not exist.")
         return
 
-    for root, dirs, files in os.walk(temp_dir, topdown=False):
-        for file_name in files:
-            file_path = os.path.join(root, file_name)
-            os.remove(file_path)
-            print(f"Deleted file: {file_path}")
-        for dir_name in dirs:
-            dir_path = os.path.join(root, dir_name)
-            os.rmdir(dir_path)
-            print(f"Deleted directory: {dir_path}")
+    _rmtree_scandir(temp_dir)
 
     # Finally, remove the root temporary directory itself
     os.rmdir(temp_dir)
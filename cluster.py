@@ -41,88 +41,160 @@
 # print("Files have been organized by cafe ID and date!")
 
 
+import logging
 import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Set up AWS S3
 s3_bucket_name = 'pos-receipts-stm-files'
 source_folder = 'stm_files'             # Source folder containing the unorganized .stm files
 destination_folder = 'clustered_receipts' # Destination folder in S3 for organized files
 
-# Initialize the S3 client
-s3_client = boto3.client('s3')
-
-# Pagination control
-continuation_token = None
-
-while True:
-    # List objects with pagination in the source folder
-    if continuation_token:
-        objects = s3_client.list_objects_v2(
-            Bucket=s3_bucket_name,
-            Prefix=source_folder,
-            ContinuationToken=continuation_token
+# Log to stdout; per-file messages are DEBUG (set CLUSTER_LOG_LEVEL=DEBUG to see them)
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('CLUSTER_LOG_LEVEL', 'INFO').upper())
+
+# Log progress every this many files
+progress_interval = 100
+
+# Number of files organized concurrently (the work is dominated by S3 round-trips)
+max_workers = int(os.environ.get('CLUSTER_MAX_WORKERS', 20))
+
+# One client for the copy workers and the source-listing thread: each copy holds a single connection,
+# so the pool needs max_workers + 1; adaptive retries absorb throttling during copy bursts
+s3_client = boto3.client('s3', config=Config(
+    max_pool_connections=max(64, max_workers + 1),
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    tcp_keepalive=True
+))
+
+# A receipt copy is one CopyObject request, so the managed copy needs neither threads nor multipart
+small_transfer_config = TransferConfig(use_threads=False, multipart_threshold=64 * 1024 * 1024)
+
+# Counters updated from the worker threads
+stats = {'organized': 0, 'skipped': 0, 'failed': 0}
+stats_lock = threading.Lock()
+
+
+def organize_file(s3_key):
+    """Copy a single .stm file into its cafe ID / date folder and return the outcome."""
+    filename = os.path.basename(s3_key)
+
+    # Extract the last 4 digits (cafe ID) from the filename
+    cafe_id = filename[-8:-4]
+
+    # Extract the date (YYYYMMDD) from the filename
+    try:
+        date = filename.split('_')[0].split('-')[2]  # Adjust this if needed
+    except IndexError:
+        logger.warning("Date extraction failed for %s. Skipping.", filename)
+        return 'failed'
+
+    # Define the S3 destination path in the organized structure
+    organized_s3_key = f"{destination_folder}/{cafe_id}/{date}/{filename}"
+
+    # Check if the file already exists in the destination folder
+    if organized_s3_key in existing_keys:
+        logger.debug("File %s already exists in destination. Skipping.", organized_s3_key)
+        return 'skipped'  # Skip if the file exists
+
+    # Copy the file to the new organized S3 location entirely server-side (no local download)
+    try:
+        s3_client.copy(
+            {'Bucket': s3_bucket_name, 'Key': s3_key}, s3_bucket_name, organized_s3_key,
+            Config=small_transfer_config
         )
-    else:
-        objects = s3_client.list_objects_v2(
+        logger.debug("Copied %s to s3://%s/%s", filename, s3_bucket_name, organized_s3_key)
+        return 'organized'
+    except Exception as e:
+        logger.error("Error processing %s: %s", filename, e)
+        return 'failed'
+
+
+def record_result(s3_key):
+    try:
+        result = organize_file(s3_key)
+    except Exception as e:
+        logger.error("Error processing %s: %s", s3_key, e)
+        result = 'failed'
+    with stats_lock:
+        stats[result] += 1
+        done = sum(stats.values())
+    if done % progress_interval == 0:
+        logger.info("Progress: %d files handled", done)
+
+
+def queue_source_keys(key_queue, listing_errors):
+    """Walk the flat stm_files/ listing and hand each .stm key to the copy workers."""
+    try:
+        page_iterator = s3_client.get_paginator('list_objects_v2').paginate(
             Bucket=s3_bucket_name,
-            Prefix=source_folder
+            Prefix=source_folder,
+            PaginationConfig={'PageSize': 1000}  # the source folder is flat, so take the largest pages
         )
-    
-    # Check if objects were found in the specified S3 folder
-    if 'Contents' in objects:
-        for obj in objects['Contents']:
-            s3_key = obj['Key']
-            
-            # Process only .stm files
-            if s3_key.endswith(".stm"):
-                filename = os.path.basename(s3_key)
-                
-                # Extract the last 4 digits (cafe ID) from the filename
-                cafe_id = filename[-8:-4]
-                
-                # Extract the date (YYYYMMDD) from the filename
-                try:
-                    date = filename.split('_')[0].split('-')[2]  # Adjust this if needed
-                except IndexError:
-                    print(f"Date extraction failed for {filename}. Skipping.")
-                    continue
-
-                # Define the S3 destination path in the organized structure
-                organized_s3_key = f"{destination_folder}/{cafe_id}/{date}/{filename}"
-                
-                # Check if the file already exists in the destination folder
-                try:
-                    s3_client.head_object(Bucket=s3_bucket_name, Key=organized_s3_key)
-                    print(f"File {organized_s3_key} already exists in destination. Skipping.")
-                    continue  # Skip if the file exists
-                except s3_client.exceptions.ClientError as e:
-                    # If the file does not exist, proceed with download and upload
-                    if e.response['Error']['Code'] != '404':
-                        print(f"Error checking existence of {organized_s3_key}: {e}")
-                        continue
-
-                # Download the file temporarily to the local system
-                local_path = filename
-                try:
-                    s3_client.download_file(s3_bucket_name, s3_key, local_path)
-                    # Upload the file to the new organized S3 location
-                    s3_client.upload_file(local_path, s3_bucket_name, organized_s3_key)
-                    print(f"Uploaded {filename} to s3://{s3_bucket_name}/{organized_s3_key}")
-                except Exception as e:
-                    print(f"Error processing {filename}: {e}")
-                finally:
-                    # Clean up the local file if it exists
-                    if os.path.exists(local_path):
-                        os.remove(local_path)
-
-        # Check if there are more pages of results
-        if objects.get('IsTruncated'):
-            continuation_token = objects['NextContinuationToken']
-        else:
-            break
-    else:
-        print("No .stm files found in the specified S3 bucket and folder.")
-        break
-
-print("All .stm files have been organized by cafe ID and date in S3.")
+        for page in page_iterator:
+            for obj in page.get('Contents', []):
+                # Process only .stm files
+                if obj['Key'].endswith(".stm"):
+                    key_queue.put(obj['Key'])
+    except Exception as e:
+        listing_errors.append(e)
+    finally:
+        # A None per copy worker tells each of them the listing is finished
+        for _ in range(max_workers):
+            key_queue.put(None)
+
+
+def copy_worker(key_queue):
+    for s3_key in iter(key_queue.get, None):
+        record_result(s3_key)
+
+
+# Collect every key already in the destination folder up front, so the per-file existence check
+# is a set lookup instead of a head_object round-trip
+existing_keys = set()
+destination_pages = s3_client.get_paginator('list_objects_v2').paginate(
+    Bucket=s3_bucket_name,
+    Prefix=f"{destination_folder}/",
+    PaginationConfig={'PageSize': 1000}
+)
+try:
+    for page in destination_pages:
+        existing_keys.update(obj['Key'] for obj in page.get('Contents', []))
+except (ClientError, BotoCoreError) as e:
+    # This is the first request, so a missing bucket or denied access is reported here
+    logger.error("Error listing s3://%s/%s/: %s", s3_bucket_name, destination_folder, e)
+    sys.exit(1)
+
+# List the source folder in its own thread so LIST round-trips overlap with the copies
+key_queue = queue.Queue(maxsize=1000)
+listing_errors = []
+producer = threading.Thread(target=queue_source_keys, args=(key_queue, listing_errors), daemon=True)
+producer.start()
+
+# Overlap the per-file S3 round-trips across a pool of worker threads
+with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    for future in [executor.submit(copy_worker, key_queue) for _ in range(max_workers)]:
+        future.result()
+producer.join()
+
+if listing_errors:
+    logger.error("Error listing s3://%s/%s: %s", s3_bucket_name, source_folder, listing_errors[0])
+    sys.exit(1)
+
+if sum(stats.values()) == 0:
+    logger.info("No .stm files found in the specified S3 bucket and folder.")
+else:
+    logger.info("Organized: %d, skipped: %d, failed: %d", stats['organized'], stats['skipped'], stats['failed'])
+    logger.info("All .stm files have been organized by cafe ID and date in S3.")
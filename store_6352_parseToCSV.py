@@ -1,87 +1,233 @@
 import re
 import csv
-import boto3
+import io
+import logging
 import os
+import queue
+import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 # AWS S3 bucket and folder structure
 s3_bucket_name = 'pos-receipts-stm-files'
 s3_source_folder = 'clustered_receipts'  # Source folder in S3 for receipts
 s3_destination_folder = 'processed_receipts'  # Destination folder in S3 for parsed CSVs
+cafe_filter = '6352'  # Only this cafe's receipts are parsed
+
+# Log to stdout; PARSE_LOG_LEVEL=WARNING hides the progress lines
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('PARSE_LOG_LEVEL', 'INFO').upper())
+
+# Log progress every this many files
+progress_interval = 100
+
+# Receipt patterns, compiled once instead of on every file. They are deliberately kept separate:
+# the header searches stop at their first match and each literal-prefixed pattern uses re's fast
+# prefix scan, which beats a single alternation that must try every branch at every position
+ORDER_NO_PATTERN = re.compile(rb"Order No: (\d+)")
+TIME_PATTERN = re.compile(rb"\d{2}:\d{2}:\d{2}")  # Format: HH:MM:SS
+TOTAL_AMOUNT_PATTERN = re.compile(rb"Total amount: ([\d.]+) EUR")
+# `.+?` cannot cross a newline, so backtracking is bounded by the length of one item line; the stdlib
+# engine is faster here than a linear-time DFA engine such as RE2, whose per-call overhead dominates
+ITEM_PATTERN = re.compile(rb"(\d+ - .+?) // ([\d.]+ EUR) // VAT: ([\d.]+%)")
+
+CSV_HEADERS = ["cafe_id", "date", "time", "order_no", "item", "price", "vat", "total_amount"]
+
+
+def iter_rows(content, cafe_id, date):
+    """Yield one CSV row per item found in the raw (bytes) receipt content."""
+    # The patterns are bytes patterns, so only the matched fields are decoded, never the whole receipt
+    # Extract order number
+    order_no_match = ORDER_NO_PATTERN.search(content)
+    order_no = order_no_match.group(1).decode() if order_no_match else None
+
+    # Extract time from content (since date is in folder name)
+    time_match = TIME_PATTERN.search(content)
+    time = time_match.group(0).decode() if time_match else None
+
+    # Extract total amount
+    total_amount_match = TOTAL_AMOUNT_PATTERN.search(content)
+    total_amount = total_amount_match.group(1).decode() if total_amount_match else None
+
+    # Each item match is (quantity - item_name, price, vat); stream them without building a list
+    for item in ITEM_PATTERN.finditer(content):
+        yield (
+            cafe_id, date, time, order_no,
+            item.group(1).decode('utf-8', 'ignore'), item.group(2).decode(), item.group(3).decode(),
+            total_amount
+        )
+
+
+def process_stm_file(s3_key, cafe_id, date):
+    """Parse one .stm receipt from S3 and return its item rows."""
+    # Read the raw .stm bytes straight from S3 into memory
+    content = s3_client.get_object(Bucket=s3_bucket_name, Key=s3_key)['Body'].read()
+    return list(iter_rows(content, cafe_id, date))
+
+
+def receipt_sort_key(receipt):
+    # Filenames look like hds-03-20241028_081322-6352.stm: sort on the timestamp so receipts from
+    # different printers interleave by time, with the full filename as a tie-breaker
+    filename = receipt[0]
+    parts = filename.split('-')
+    return (parts[2] if len(parts) > 2 else '', filename)
+
+
+def upload_group_csv(cafe_id, date, receipts):
+    """Upload one combined CSV holding every receipt of a cafe_id and date."""
+    # Build the CSV in memory: header row, then the item rows of each receipt in time order
+    csv_buffer = io.StringIO()
+    writer = csv.writer(csv_buffer)
+    writer.writerow(CSV_HEADERS)
+    ordered_receipts = sorted(receipts, key=receipt_sort_key)
+    writer.writerows(chain.from_iterable(rows for _, rows in ordered_receipts))
+
+    # Define the destination path in S3
+    s3_destination_key = f"{s3_destination_folder}/cafe_{cafe_id}/date_{date}/receipts.csv"
 
-# Initialize S3 client
-s3_client = boto3.client('s3')
-
-# List all .stm files in the S3 bucket under the source folder
-objects = s3_client.list_objects_v2(Bucket=s3_bucket_name, Prefix=s3_source_folder)
-
-if 'Contents' in objects:
-    for obj in objects['Contents']:
-        s3_key = obj['Key']  # S3 object key (file path)
-
-        # Process only .stm files and filter for cafe 6352
-        if s3_key.endswith(".stm") and '/6352/' in s3_key:
-            # Extract cafe_id, date, and filename from the folder structure in S3 key
-            try:
-                _, _, cafe_id, date, filename = s3_key.split('/')
-            except ValueError:
-                print(f"Unexpected file structure for {s3_key}. Skipping.")
-                continue
-
-            # Temporary download path for the .stm file
-            local_path = '/tmp/' + filename
-            s3_client.download_file(s3_bucket_name, s3_key, local_path)
-
-            # Use the original `.stm` filename for the CSV file, replacing the extension
-            csv_filename = filename.replace('.stm', '.csv')
-            
-            # Open or create the CSV file for appending data
-            with open(csv_filename, mode='a', newline='') as csv_file:
-                writer = csv.writer(csv_file)
-                
-                # If the file is new, write the header row
-                if os.stat(csv_filename).st_size == 0:
-                    writer.writerow(["cafe_id", "date", "time", "order_no", "item", "price", "vat", "total_amount"])
-                
-                # Read and parse the .stm file
-                with open(local_path, 'r') as file:
-                    content = file.read()
-                    
-                    # Extract order number
-                    order_no_match = re.search(r"Order No: (\d+)", content)
-                    order_no = order_no_match.group(1) if order_no_match else None
-                    
-                    # Extract time from content (since date is in folder name)
-                    time_match = re.search(r"\d{2}:\d{2}:\d{2}", content)  # Format: HH:MM:SS
-                    time = time_match.group(0) if time_match else None
-                    
-                    # Extract total amount
-                    total_amount_match = re.search(r"Total amount: ([\d.]+) EUR", content)
-                    total_amount = total_amount_match.group(1) if total_amount_match else None
-                    
-                    # Find items and prices
-                    items = re.findall(r"(\d+ - .+?) // ([\d.]+ EUR) // VAT: ([\d.]+%)", content)
-                    
-                    for item in items:
-                        # Each item in items is a tuple (quantity - item_name, price, vat)
-                        item_name = item[0]
-                        price = item[1]
-                        vat = item[2]
-                        
-                        # Write row to the CSV file for the specific cafe_id and date
-                        writer.writerow([cafe_id, date, time, order_no, item_name, price, vat, total_amount])
-
-            # Define the destination path in S3, preserving the original filename
-            s3_destination_key = f"{s3_destination_folder}/cafe_{cafe_id}/date_{date}/{csv_filename}"
-            
-            # Upload the CSV file to the structured path in S3
-            s3_client.upload_file(csv_filename, s3_bucket_name, s3_destination_key)
-            print(f"Uploaded {csv_filename} to s3://{s3_bucket_name}/{s3_destination_key}")
-
-            # Remove the local .stm and CSV files after processing
-            os.remove(local_path)
-            os.remove(csv_filename)
+    # Upload the CSV file to the structured path in S3
+    csv_bytes = io.BytesIO(csv_buffer.getvalue().encode('utf-8'))
+    s3_client.upload_fileobj(csv_bytes, s3_bucket_name, s3_destination_key, Config=large_transfer_config)
+    logger.info("Uploaded %d receipts to s3://%s/%s", len(receipts), s3_bucket_name, s3_destination_key)
 
+
+def record_result(s3_key):
+    # Extract cafe_id, date, and filename from the folder structure in S3 key
+    try:
+        _, cafe_id, date, filename = s3_key.split('/')
+    except ValueError:
+        logger.warning("Unexpected file structure for %s. Skipping.", s3_key)
+        return
+
+    try:
+        rows = process_stm_file(s3_key, cafe_id, date)
+    except Exception as e:
+        logger.error("Error processing %s: %s", s3_key, e)
+        result = 'failed'
+    else:
+        result = 'processed'
+
+    with stats_lock:
+        stats[result] += 1
+        if result == 'processed':
+            groups[(cafe_id, date)].append((filename, rows))
+        else:
+            failed_groups.add((cafe_id, date))
+        done = stats['processed'] + stats['failed']
+    if done % progress_interval == 0:
+        logger.info("Progress: %d receipts parsed", done)
+
+
+def queue_cafe_receipts(key_queue, listing_errors):
+    """List the filtered cafe's receipts for the parse workers; None marks the end for each worker."""
+    # Receipts are organized as <source folder>/<cafe_id>/<date>/<file>, so listing only the cafe's
+    # prefix lets S3 do the filtering instead of paging through every other cafe's keys
+    cafe_prefix = f"{s3_source_folder}/{cafe_filter}/"
+    try:
+        for page in s3_client.get_paginator('list_objects_v2').paginate(
+            Bucket=s3_bucket_name, Prefix=cafe_prefix, PaginationConfig={'PageSize': 1000}
+        ):
+            # Process only .stm files
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith(".stm"):
+                    key_queue.put(obj['Key'])
+    except Exception as e:
+        listing_errors.append(e)
+    finally:
+        for _ in range(max_workers):
+            key_queue.put(None)
+
+
+def parse_worker(key_queue):
+    s3_key = key_queue.get()
+    while s3_key is not None:
+        record_result(s3_key)
+        s3_key = key_queue.get()
+
+
+# Number of receipts parsed concurrently (each one is a get_object round-trip)
+max_workers = int(os.environ.get('PARSE_MAX_WORKERS', 16))
+
+# Shared by the parse workers (one get_object each), the listing thread and then the group uploads on
+# the same executor, which send their parts serially, so max_workers + 1 connections cover all of them
+s3_client = boto3.client('s3', config=Config(
+    max_pool_connections=max(64, max_workers + 1),
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    tcp_keepalive=True
+))
+
+# Combined CSVs can get large, so upload them in 8 MB multipart chunks; the groups are already uploaded
+# in parallel on the executor, so each upload sends its parts in its own thread
+large_transfer_config = TransferConfig(
+    use_threads=False,
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024
+)
+
+# Counters and parsed rows (grouped by cafe_id and date) updated as receipts finish; a cafe_id and date
+# with any failed receipt is not uploaded, so an incomplete CSV never replaces a good one
+stats = {'processed': 0, 'failed': 0, 'upload_failed': 0}
+groups = defaultdict(list)
+failed_groups = set()
+stats_lock = threading.Lock()
+
+# List the source folder in its own thread so LIST round-trips overlap with the parsing;
+# the bounded queue keeps huge listings from being held in memory at once
+key_queue = queue.Queue(maxsize=1000)
+listing_errors = []
+producer = threading.Thread(target=queue_cafe_receipts, args=(key_queue, listing_errors), daemon=True)
+producer.start()
+
+with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    for future in [executor.submit(parse_worker, key_queue) for _ in range(max_workers)]:
+        future.result()
+    producer.join()
+
+    # The listing is the first request, so a missing bucket or denied access is reported here
+    if listing_errors:
+        logger.error("Error listing s3://%s/%s: %s", s3_bucket_name, s3_source_folder, listing_errors[0])
+        sys.exit(1)
+
+    for cafe_id, date in sorted(failed_groups):
+        s3_destination_key = f"{s3_destination_folder}/cafe_{cafe_id}/date_{date}/receipts.csv"
+        logger.error(
+            "Skipping upload of s3://%s/%s: some receipts of this date failed to parse",
+            s3_bucket_name, s3_destination_key
+        )
+
+    # One CSV per cafe_id and date instead of one tiny object per receipt
+    uploads = {
+        executor.submit(upload_group_csv, cafe_id, date, receipts): (cafe_id, date)
+        for (cafe_id, date), receipts in groups.items()
+        if (cafe_id, date) not in failed_groups
+    }
+    for future, (cafe_id, date) in uploads.items():
+        try:
+            future.result()
+        except Exception as e:
+            s3_destination_key = f"{s3_destination_folder}/cafe_{cafe_id}/date_{date}/receipts.csv"
+            logger.error("Error uploading s3://%s/%s: %s", s3_bucket_name, s3_destination_key, e)
+            stats['upload_failed'] += 1
+
+if sum(stats.values()) == 0:
+    logger.info("No .stm files found in the specified S3 folder.")
 else:
-    print("No .stm files found in the specified S3 folder.")
+    logger.info(
+        "Processed: %d, failed: %d, CSV uploads failed: %d",
+        stats['processed'], stats['failed'], stats['upload_failed']
+    )
+
+# A partial run must not look like a successful one to whatever checks the exit status
+if stats['failed'] or stats['upload_failed']:
+    sys.exit(1)
 
-print("Parsing complete. Separate CSV files created for each date of cafe 6352 and uploaded to S3.")
+logger.info("Parsing complete. Separate CSV files created for each date of cafe %s and uploaded to S3.", cafe_filter)
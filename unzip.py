@@ -20,42 +20,101 @@
 # print("Extraction complete. .stm files are now in the 'receipts' folder.")
 
 
+import logging
+import os
+import sys
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
-import os
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 # Define the path to your zip file and S3 bucket details
 zip_file_path = 'PrintJobData_20241102.zip'
 s3_bucket_name = 'pos-receipts-stm-files'
 s3_folder = 'stm_files'  # Optional folder inside the S3 bucket to store the .stm files
 
-# Initialize the S3 client
-s3_client = boto3.client('s3')
+# Log to stdout; each upload is logged at DEBUG (UNZIP_LOG_LEVEL=DEBUG)
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('UNZIP_LOG_LEVEL', 'INFO').upper())
+
+# Log progress every this many files
+progress_interval = 100
+
+# Number of uploads in flight at once
+max_workers = int(os.environ.get('UNZIP_MAX_WORKERS', 20))
+
+# Only the upload workers use this client and each streams one receipt at a time, so the pool needs
+# max_workers connections; adaptive retries back off if S3 throttles the upload burst
+s3_client = boto3.client('s3', config=Config(
+    max_pool_connections=max(64, max_workers),
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    tcp_keepalive=True
+))
+
+# Each receipt is a few KB: send it as a single PUT from the worker thread that read it
+small_transfer_config = TransferConfig(use_threads=False, multipart_threshold=64 * 1024 * 1024)
+
+# Number of files uploaded (or failed) so far, updated from the worker threads
+uploaded = 0
+failed = 0
+uploaded_lock = threading.Lock()
+
 
-# Temporary directory to extract files
-temp_dir = 'extracted_stm_files'
+def upload_stm_file(zip_ref, file_info):
+    global uploaded, failed
 
-# Create the temp directory if it doesn't exist
-os.makedirs(temp_dir, exist_ok=True)
+    # Define the S3 key (path in S3 bucket)
+    s3_key = f"{s3_folder}/{file_info.filename}" if s3_folder else file_info.filename
 
-# Extract .stm files from the zip archive
+    # Stream the decompressed .stm file straight to S3 (nothing is written to disk); a failure is
+    # logged and counted so the worker carries on with the next file
+    try:
+        with zip_ref.open(file_info) as stm_file:
+            s3_client.upload_fileobj(stm_file, s3_bucket_name, s3_key, Config=small_transfer_config)
+    except Exception as e:
+        logger.error("Error uploading %s to s3://%s/%s: %s", file_info.filename, s3_bucket_name, s3_key, e)
+        with uploaded_lock:
+            failed += 1
+        return
+    logger.debug("Uploaded %s to s3://%s/%s", file_info.filename, s3_bucket_name, s3_key)
+
+    with uploaded_lock:
+        uploaded += 1
+        done = uploaded + failed
+    if done % progress_interval == 0:
+        logger.info("Progress: %d files uploaded", done)
+
+
+def worker(stm_files, stm_files_lock):
+    # A ZipFile handle must not be read from several threads at once, so each worker opens its own
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        while True:
+            with stm_files_lock:
+                file_info = next(stm_files, None)
+            if file_info is None:
+                return
+            upload_stm_file(zip_ref, file_info)
+
+
+# Lazily pick the .stm files out of the zip archive and let the workers pull from that generator,
+# so no per-file list or future is ever built
 with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-    for file_info in zip_ref.infolist():
-        if file_info.filename.endswith('.stm'):
-            # Extract the file to the temp directory
-            zip_ref.extract(file_info, temp_dir)
-            file_path = os.path.join(temp_dir, file_info.filename)
-            
-            # Define the S3 key (path in S3 bucket)
-            s3_key = f"{s3_folder}/{file_info.filename}" if s3_folder else file_info.filename
-            
-            # Upload the .stm file to S3
-            s3_client.upload_file(file_path, s3_bucket_name, s3_key)
-            print(f"Uploaded {file_info.filename} to s3://{s3_bucket_name}/{s3_key}")
-
-# Cleanup: Remove the temp directory and extracted files
-for file_name in os.listdir(temp_dir):
-    os.remove(os.path.join(temp_dir, file_name))
-os.rmdir(temp_dir)
-
-print("All .stm files have been uploaded to S3.")
+    stm_files = (file_info for file_info in zip_ref.infolist() if file_info.filename.endswith('.stm'))
+    stm_files_lock = threading.Lock()
+
+    # Upload them concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(worker, stm_files, stm_files_lock) for _ in range(max_workers)]:
+            future.result()
+
+if failed:
+    logger.error("Uploaded %d .stm files to S3; %d failed.", uploaded, failed)
+    sys.exit(1)
+
+logger.info("All %d .stm files have been uploaded to S3.", uploaded)